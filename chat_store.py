@@ -0,0 +1,258 @@
+# chat_store.py
+# SQLite-based conversation history + message embeddings
+import json
+import os
+import sqlite3
+import queue
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple
+
+BASE_DIR = Path(__file__).resolve().parent
+DB_PATH = Path(os.environ.get("CHAT_DB_PATH", BASE_DIR / "chat_history.db"))
+
+# Perf knobs
+CHAT_DB_BUSY_TIMEOUT_MS = int(os.environ.get("CHAT_DB_BUSY_TIMEOUT_MS", "5000"))
+CHAT_DB_CACHED_STATEMENTS = int(os.environ.get("CHAT_DB_CACHED_STATEMENTS", "256"))
+CHAT_DB_POOL_SIZE = int(os.environ.get("CHAT_DB_POOL_SIZE", "4"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    title TEXT NOT NULL,
+    created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    conversation_id INTEGER NOT NULL REFERENCES conversations(id) ON DELETE CASCADE,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE IF NOT EXISTS message_embeddings (
+    message_id INTEGER PRIMARY KEY REFERENCES messages(id) ON DELETE CASCADE,
+    vector_json TEXT NOT NULL,
+    model TEXT NOT NULL DEFAULT '',
+    updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages(conversation_id, id);
+CREATE INDEX IF NOT EXISTS idx_messages_created ON messages(created_at);
+CREATE INDEX IF NOT EXISTS idx_conversations_updated ON conversations(updated_at DESC, id DESC);
+"""
+
+# Small module-level pool of connections shared by all threads (Streamlit starts a
+# new script thread on most interactions, so per-thread connections would not be
+# reused). sqlite3 keeps compiled statements per connection (cached_statements),
+# so the constant SQL below stays prepared across reruns.
+_pool: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue(maxsize=CHAT_DB_POOL_SIZE)
+_local = threading.local()  # connection held by this thread's open batch(), if any
+_init_lock = threading.Lock()
+_schema_ready = False
+
+
+def _open() -> sqlite3.Connection:
+    DB_PATH.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(
+        str(DB_PATH),
+        timeout=CHAT_DB_BUSY_TIMEOUT_MS / 1000,
+        isolation_level=None,  # autocommit; transactions are explicit via batch()
+        cached_statements=CHAT_DB_CACHED_STATEMENTS,
+        check_same_thread=False,  # pooled: used by one thread at a time
+    )
+    conn.row_factory = sqlite3.Row
+    # WAL lets readers run alongside a writer; NORMAL sync is durable enough with WAL
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA foreign_keys=ON")
+    conn.execute(f"PRAGMA busy_timeout={CHAT_DB_BUSY_TIMEOUT_MS}")
+    return conn
+
+
+@contextmanager
+def _connection() -> Iterator[sqlite3.Connection]:
+    """Borrow a pooled connection (or this thread's batch connection)."""
+    held = getattr(_local, "conn", None)
+    if held is not None:
+        yield held
+        return
+    try:
+        conn = _pool.get_nowait()
+    except queue.Empty:
+        conn = _open()
+    try:
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        try:
+            _pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+
+@contextmanager
+def batch() -> Iterator[sqlite3.Connection]:
+    """Group writes into one transaction on a single pooled connection.
+
+    Nested calls join the outermost transaction. The write lock is taken up
+    front (BEGIN IMMEDIATE) so concurrent sessions wait on busy_timeout
+    instead of failing mid-transaction with "database is locked".
+    """
+    held = getattr(_local, "conn", None)
+    if held is not None:
+        yield held
+        return
+    with _connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        _local.conn = conn
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            # Covers a failing COMMIT too, so the connection never goes back mid-transaction
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            _local.conn = None
+
+
+def init_db():
+    """Create tables and indexes (once per process)."""
+    global _schema_ready
+    with _init_lock:
+        if _schema_ready:
+            return
+        with _connection() as conn:
+            conn.executescript(_SCHEMA)
+            # Databases created before vectors were tagged with their model
+            columns = {r["name"] for r in conn.execute("PRAGMA table_info(message_embeddings)")}
+            if "model" not in columns:
+                conn.execute("ALTER TABLE message_embeddings ADD COLUMN model TEXT NOT NULL DEFAULT ''")
+        _schema_ready = True
+
+
+# ---------- Conversations ----------
+def create_conversation(title: str) -> int:
+    with batch() as conn:
+        cur = conn.execute("INSERT INTO conversations (title) VALUES (?)", (title,))
+        return cur.lastrowid
+
+
+def list_conversations(limit: int = 50) -> List[dict]:
+    with _connection() as conn:
+        rows = conn.execute(
+            "SELECT id, title, created_at, updated_at FROM conversations "
+            "ORDER BY updated_at DESC, id DESC LIMIT ?",
+            (limit,),
+        ).fetchall()
+    return [dict(r) for r in rows]
+
+
+def update_conversation_title(conversation_id: int, title: str):
+    with batch() as conn:
+        conn.execute(
+            "UPDATE conversations SET title = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+            (title, conversation_id),
+        )
+
+
+def delete_conversation(conversation_id: int):
+    # Messages and embeddings go with it (ON DELETE CASCADE)
+    with batch() as conn:
+        conn.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
+
+
+# ---------- Messages ----------
+def add_message(conversation_id: int, role: str, content: str) -> int:
+    with batch() as conn:
+        cur = conn.execute(
+            "INSERT INTO messages (conversation_id, role, content) VALUES (?, ?, ?)",
+            (conversation_id, role, content),
+        )
+        conn.execute(
+            "UPDATE conversations SET updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+            (conversation_id,),
+        )
+        return cur.lastrowid
+
+
+def get_messages(conversation_id: int) -> List[dict]:
+    with _connection() as conn:
+        rows = conn.execute(
+            "SELECT id, conversation_id, role, content, created_at FROM messages "
+            "WHERE conversation_id = ? ORDER BY id",
+            (conversation_id,),
+        ).fetchall()
+    return [dict(r) for r in rows]
+
+
+def count_messages(conversation_id: int) -> int:
+    with _connection() as conn:
+        row = conn.execute(
+            "SELECT COUNT(*) FROM messages WHERE conversation_id = ?", (conversation_id,)
+        ).fetchone()
+    return row[0]
+
+
+def search_messages(query: str, limit: int = 20) -> List[dict]:
+    """Keyword (substring) search; one hit per conversation, most recent first."""
+    with _connection() as conn:
+        rows = conn.execute(
+            "SELECT m.conversation_id, c.title, substr(m.content, 1, 120) AS snippet, MAX(m.id) AS message_id "
+            "FROM messages m JOIN conversations c ON c.id = m.conversation_id "
+            "WHERE m.content LIKE ? GROUP BY m.conversation_id ORDER BY message_id DESC LIMIT ?",
+            (f"%{query}%", limit),
+        ).fetchall()
+    return [dict(r) for r in rows]
+
+
+# ---------- Embeddings ----------
+def upsert_message_embedding(message_id: int, vector: Sequence[float], model: str = ""):
+    upsert_message_embeddings([(message_id, vector)], model=model)
+
+
+def upsert_message_embeddings(items: Iterable[Tuple[int, Sequence[float]]], model: str = ""):
+    """Store several (message_id, vector) pairs in one transaction, tagged with the model that made them."""
+    rows = [(message_id, json.dumps(list(vector)), model, message_id) for message_id, vector in items]
+    if not rows:
+        return
+    with batch() as conn:
+        # Skips messages deleted since they were queued (e.g. conversation removed)
+        conn.executemany(
+            "INSERT INTO message_embeddings (message_id, vector_json, model) "
+            "SELECT ?, ?, ? WHERE EXISTS (SELECT 1 FROM messages WHERE id = ?) "
+            "ON CONFLICT(message_id) DO UPDATE SET vector_json = excluded.vector_json, "
+            "model = excluded.model, updated_at = CURRENT_TIMESTAMP",
+            rows,
+        )
+
+
+def get_messages_needing_embeddings(model: str) -> List[dict]:
+    """Messages with no embedding, or one made by a different model (for backfill)."""
+    with _connection() as conn:
+        rows = conn.execute(
+            "SELECT m.id AS message_id, m.content FROM messages m "
+            "LEFT JOIN message_embeddings e ON e.message_id = m.id "
+            "WHERE e.message_id IS NULL OR e.model != ? ORDER BY m.id",
+            (model,),
+        ).fetchall()
+    return [dict(r) for r in rows]
+
+
+def get_messages_with_embeddings(conversation_id: Optional[int] = None) -> List[dict]:
+    """All messages with their embedding JSON and model (both None if not embedded yet)."""
+    sql = (
+        "SELECT m.id AS message_id, m.conversation_id, c.title, m.role, m.content, e.vector_json, e.model "
+        "FROM messages m JOIN conversations c ON c.id = m.conversation_id "
+        "LEFT JOIN message_embeddings e ON e.message_id = m.id"
+    )
+    params: tuple = ()
+    if conversation_id is not None:
+        sql += " WHERE m.conversation_id = ?"
+        params = (conversation_id,)
+    with _connection() as conn:
+        rows = conn.execute(sql + " ORDER BY m.id", params).fetchall()
+    return [dict(r) for r in rows]
@@ -0,0 +1,127 @@
+# context_builder.py
+# Token-budgeted multi-turn context for OpenAI-compatible chat endpoints
+import os
+import textwrap
+from typing import Dict, List, Optional
+
+SYSTEM_PROMPT = "You are a helpful assistant."
+
+# Perf knobs
+# Total context window of the served model; the reply must fit in it too
+CHAT_CONTEXT_TOKENS = int(os.environ.get("CHAT_CONTEXT_TOKENS", "4096"))
+CHAT_RESPONSE_TOKENS = int(os.environ.get("CHAT_RESPONSE_TOKENS", "1024"))
+CHAT_TOOL_OUTPUT_TOKENS = int(os.environ.get("CHAT_TOOL_OUTPUT_TOKENS", "512"))
+CHAT_SUMMARY_TOKENS = int(os.environ.get("CHAT_SUMMARY_TOKENS", "256"))
+# Oldest history is dropped in steps of this many messages, so the prompt prefix
+# stays byte-identical across turns and the server can reuse its KV cache
+CHAT_HISTORY_STEP = max(1, int(os.environ.get("CHAT_HISTORY_STEP", "8")))
+
+# Rough chars-per-token ratio; avoids pulling in a tokenizer for the served model
+_CHARS_PER_TOKEN = 4
+_MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text or "") // _CHARS_PER_TOKEN + 1
+
+
+def _message_tokens(msg: Dict[str, str]) -> int:
+    return estimate_tokens(msg["content"]) + _MESSAGE_OVERHEAD_TOKENS
+
+
+def cap_text(text: str, max_tokens: int) -> str:
+    """Trim text to roughly max_tokens, marking the cut."""
+    limit = max_tokens * _CHARS_PER_TOKEN
+    if len(text) <= limit:
+        return text
+    return text[:limit] + "\n… [truncated]"
+
+
+def tool_message(tool_result: str) -> Dict[str, str]:
+    return {"role": "system", "content": f"Tool result: {cap_text(str(tool_result), CHAT_TOOL_OUTPUT_TOKENS)}"}
+
+
+def _history_message(msg: dict) -> Optional[Dict[str, str]]:
+    content = msg.get("content") or ""
+    if not content:
+        return None
+    role = msg.get("role")
+    if role == "tool":
+        return tool_message(content)
+    return {"role": "user" if role == "user" else "assistant", "content": content}
+
+
+def _summarize(dropped: List[Dict[str, str]]) -> Dict[str, str]:
+    """Deterministic extractive summary of dropped turns (same input -> same bytes)."""
+    lines = []
+    for m in dropped:
+        if m["role"] == "system":
+            continue
+        snippet = textwrap.shorten(m["content"], width=120, placeholder="…")
+        lines.append(f"- {m['role']}: {snippet}")
+    header = "Earlier conversation (older turns omitted):"
+    # Keep the most recent of the dropped lines that fit the summary budget
+    kept: List[str] = []
+    used = estimate_tokens(header)
+    for line in reversed(lines):
+        cost = estimate_tokens(line)
+        if used + cost > CHAT_SUMMARY_TOKENS:
+            break
+        kept.append(line)
+        used += cost
+    return {"role": "system", "content": "\n".join([header] + list(reversed(kept)))}
+
+
+def build_messages(
+    prompt: str,
+    history: Optional[List[dict]] = None,
+    tool_result: Optional[str] = None,
+    budget: Optional[int] = None,
+) -> List[Dict[str, str]]:
+    """Pack prior turns plus the current prompt into a token budget.
+
+    history is the list returned by chat_store.get_messages (oldest first), excluding
+    the current prompt. Layout: system prompt, optional summary of dropped turns,
+    kept history, current user prompt, then the current tool result. Everything
+    before the current prompt only changes when another step of old messages is
+    dropped, which keeps it cacheable by llama.cpp / LM Studio. CHAT_RESPONSE_TOKENS
+    of the budget are left free for the reply, and the latest exchange (last user
+    message onward) is always kept, trimmed if it alone overflows the budget.
+    """
+    budget = budget or CHAT_CONTEXT_TOKENS
+    system = {"role": "system", "content": SYSTEM_PROMPT}
+    tail = [{"role": "user", "content": prompt}]
+    if tool_result:
+        tail.append(tool_message(tool_result))
+
+    rendered = [m for m in (_history_message(h) for h in (history or [])) if m]
+    costs = [_message_tokens(m) for m in rendered]
+    available = (
+        budget - CHAT_RESPONSE_TOKENS - _message_tokens(system) - sum(_message_tokens(m) for m in tail)
+    )
+
+    # Smallest step-aligned cut whose remaining history (plus summary, if any) fits
+    cut = 0
+    while cut < len(rendered):
+        reserve = CHAT_SUMMARY_TOKENS + _MESSAGE_OVERHEAD_TOKENS if cut else 0
+        if sum(costs[cut:]) + reserve <= available:
+            break
+        cut += CHAT_HISTORY_STEP
+    # Never drop the previous exchange: cut at most up to the last user message
+    last_user = max((i for i, m in enumerate(rendered) if m["role"] == "user"), default=max(len(rendered) - 1, 0))
+    cut = min(cut, last_user)
+    kept = rendered[cut:]
+    if kept:
+        reserve = CHAT_SUMMARY_TOKENS + _MESSAGE_OVERHEAD_TOKENS if cut else 0
+        room = available - reserve
+        if sum(costs[cut:]) > room:
+            # Only possible for the minimum kept exchange; share what room is left between its messages
+            per_message = max(room // len(kept) - _MESSAGE_OVERHEAD_TOKENS, 1)
+            kept = [{"role": m["role"], "content": cap_text(m["content"], per_message)} for m in kept]
+
+    messages = [system]
+    if cut:
+        messages.append(_summarize(rendered[:cut]))
+    messages.extend(kept)
+    messages.extend(tail)
+    return messages
@@ -0,0 +1,157 @@
+# embedding_service.py
+# Single shared text-embedding model for chat search and book RAG
+import hashlib
+import os
+import threading
+from array import array
+from collections import OrderedDict
+from typing import List, Optional, Sequence
+
+# Perf knobs
+EMBED_MODEL = os.environ.get("EMBED_MODEL", "BAAI/bge-small-en-v1.5")
+# "torch" (default) or "onnx" (CPU-friendly; uses an int8-quantized graph when the model ships one)
+EMBED_BACKEND = os.environ.get("EMBED_BACKEND", "torch").strip().lower()
+EMBED_ONNX_FILE = os.environ.get("EMBED_ONNX_FILE", "onnx/model_qint8_avx512_vnni.onnx")
+EMBED_DEVICE = os.environ.get("EMBED_DEVICE") or None
+EMBED_BATCH_SIZE = int(os.environ.get("EMBED_BATCH_SIZE", "32"))
+# Cached vectors are float32 (~1.6 KB each at 384 dims), so the default is ~8 MB
+EMBED_CACHE_SIZE = int(os.environ.get("EMBED_CACHE_SIZE", "5000"))
+
+
+def _default_query_instruction(model_name: str) -> str:
+    # BGE English models are trained with an instruction prefix on queries (not on passages)
+    name = model_name.lower()
+    if "bge-" in name and "-en" in name:
+        return "Represent this question for searching relevant passages: "
+    return ""
+
+
+EMBED_QUERY_INSTRUCTION = os.environ.get(
+    "EMBED_QUERY_INSTRUCTION", _default_query_instruction(EMBED_MODEL)
+)
+
+# Lazy singletons
+_model = None
+_backend: Optional[str] = None
+_load_error: Optional[str] = None
+_fallback_reason: Optional[str] = None
+_load_lock = threading.Lock()
+_encode_lock = threading.Lock()
+_cache: "OrderedDict[bytes, array]" = OrderedDict()
+_cache_lock = threading.Lock()
+_cache_stats = {"hits": 0, "misses": 0}
+
+
+def _load_model():
+    """Load the configured model once. Returns None if sentence-transformers is missing."""
+    global _model, _backend, _load_error, _fallback_reason
+    with _load_lock:
+        if _model is not None or _load_error is not None:
+            return _model
+        try:
+            from sentence_transformers import SentenceTransformer
+        except Exception as e:
+            _load_error = f"sentence-transformers not installed ({e}). Install with: pip install sentence-transformers"
+            return None
+        if EMBED_BACKEND == "onnx":
+            try:
+                _model = SentenceTransformer(
+                    EMBED_MODEL,
+                    device=EMBED_DEVICE,
+                    backend="onnx",
+                    model_kwargs={"file_name": EMBED_ONNX_FILE},
+                )
+                _backend = "onnx"
+                return _model
+            except Exception as e:
+                # Older sentence-transformers, missing optimum/onnxruntime, or no such ONNX file
+                _fallback_reason = f"ONNX backend unavailable, using torch: {e}"
+        try:
+            _model = SentenceTransformer(EMBED_MODEL, device=EMBED_DEVICE)
+            _backend = "torch"
+        except Exception as e:
+            _load_error = str(e)
+        return _model
+
+
+def available() -> bool:
+    return _load_model() is not None
+
+
+def load_error() -> Optional[str]:
+    return _load_error
+
+
+def info() -> dict:
+    """Model/backend/cache details for display."""
+    with _cache_lock:
+        return {
+            "model": EMBED_MODEL,
+            "backend": _backend,
+            "loaded": _model is not None,
+            "error": _load_error,
+            "fallback_reason": _fallback_reason,
+            "cache_entries": len(_cache),
+            "cache_hits": _cache_stats["hits"],
+            "cache_misses": _cache_stats["misses"],
+        }
+
+
+def _cache_key(text: str) -> bytes:
+    return hashlib.sha256(f"{EMBED_MODEL}\0{text}".encode("utf-8")).digest()
+
+
+def encode(texts: Sequence[str], batch_size: Optional[int] = None, store: bool = True) -> List[List[float]]:
+    """Embed passages in batches, reusing cached vectors for identical text.
+
+    Pass store=False for bulk work (e.g. book ingestion) whose vectors are
+    unlikely to be requested again: the cache is still consulted but not filled.
+    Raises RuntimeError if no embedding model is available.
+    """
+    if not texts:
+        return []
+    keys = [_cache_key(t) for t in texts]
+    results: List[Optional[List[float]]] = [None] * len(texts)
+    missing: "OrderedDict[bytes, str]" = OrderedDict()
+    with _cache_lock:
+        for i, key in enumerate(keys):
+            vec = _cache.get(key)
+            if vec is not None:
+                _cache.move_to_end(key)
+                results[i] = vec.tolist()
+                _cache_stats["hits"] += 1
+            else:
+                missing.setdefault(key, texts[i])
+                _cache_stats["misses"] += 1
+
+    if missing:
+        model = _load_model()
+        if model is None:
+            raise RuntimeError(_load_error or "No embedding model available.")
+        with _encode_lock:
+            vectors = model.encode(
+                list(missing.values()),
+                batch_size=batch_size or EMBED_BATCH_SIZE,
+                normalize_embeddings=True,
+                show_progress_bar=False,
+            )
+        fresh = {
+            key: (vec.tolist() if hasattr(vec, "tolist") else list(vec))
+            for key, vec in zip(missing.keys(), vectors)
+        }
+        if store and EMBED_CACHE_SIZE > 0:
+            with _cache_lock:
+                for key, vec in fresh.items():
+                    _cache[key] = array("f", vec)
+                    _cache.move_to_end(key)
+                while len(_cache) > EMBED_CACHE_SIZE:
+                    _cache.popitem(last=False)
+        for i, key in enumerate(keys):
+            if results[i] is None:
+                results[i] = fresh[key]
+    return results  # type: ignore[return-value]
+
+
+def encode_query(text: str) -> List[float]:
+    """Embed a search query (applies the model's query instruction, if any)."""
+    return encode([f"{EMBED_QUERY_INSTRUCTION}{text}"])[0]
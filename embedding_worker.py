@@ -0,0 +1,138 @@
+# embedding_worker.py
+# Background, batched embedding of chat messages for semantic search
+import os
+import queue
+import threading
+import time
+from typing import Iterable, List, Optional, Tuple
+
+import embedding_service
+from chat_store import get_messages_needing_embeddings, upsert_message_embeddings
+
+# Perf knobs
+EMBED_BATCH_SIZE = embedding_service.EMBED_BATCH_SIZE
+# Seconds to yield between backfill-only batches so live turns stay responsive
+EMBED_BACKFILL_PAUSE = float(os.environ.get("EMBED_BACKFILL_PAUSE", "0.2"))
+
+# Queue priorities: lower drains first
+PRIORITY_LIVE = 0
+PRIORITY_BACKFILL = 1
+
+# Shared by every Streamlit session in this process
+_queue: "queue.PriorityQueue[Tuple[int, int, int, str]]" = queue.PriorityQueue()
+_queued_ids: set = set()
+_state_lock = threading.Lock()
+_seq = 0
+_worker: Optional[threading.Thread] = None
+_backfill_started = False
+_stats = {"done": 0, "failed": 0, "total": 0, "last_error": None}
+
+
+def enqueue(items: Iterable[Tuple[int, str]], priority: int = PRIORITY_LIVE) -> int:
+    """Queue (message_id, text) pairs for embedding. Returns how many were added."""
+    global _seq
+    added = 0
+    with _state_lock:
+        for message_id, text in items:
+            if message_id is None or not text or message_id in _queued_ids:
+                continue
+            _queued_ids.add(message_id)
+            _seq += 1
+            _queue.put((priority, _seq, message_id, text))
+            _stats["total"] += 1
+            added += 1
+    if added:
+        start()
+    return added
+
+
+def backfill() -> int:
+    """Queue stored messages with no embedding, or one from another model, at low priority.
+
+    Runs once per process; a failed scan is retried on the next call.
+    """
+    global _backfill_started
+    with _state_lock:
+        if _backfill_started:
+            return 0
+        _backfill_started = True
+    try:
+        rows = get_messages_needing_embeddings(embedding_service.EMBED_MODEL)
+    except Exception as e:
+        with _state_lock:
+            _backfill_started = False
+        _stats["last_error"] = f"backfill scan failed: {e}"
+        return 0
+    if (_stats["last_error"] or "").startswith("backfill scan failed"):
+        _stats["last_error"] = None
+    pending = [(r["message_id"], r["content"]) for r in rows]
+    return enqueue(pending, priority=PRIORITY_BACKFILL)
+
+
+def start():
+    """Start the worker thread if it is not already running."""
+    global _worker
+    with _state_lock:
+        if _worker is not None and _worker.is_alive():
+            return
+        _worker = threading.Thread(target=_run, name="embedding-worker", daemon=True)
+        _worker.start()
+
+
+def progress() -> dict:
+    """Snapshot of worker progress for the UI."""
+    with _state_lock:
+        running = _worker is not None and _worker.is_alive()
+        return {
+            "running": running,
+            "pending": _queue.qsize(),
+            "done": _stats["done"],
+            "failed": _stats["failed"],
+            "total": _stats["total"],
+            "last_error": _stats["last_error"] or embedding_service.load_error(),
+        }
+
+
+def _next_batch() -> List[Tuple[int, int, int, str]]:
+    # Block for the first item, then take whatever else is ready up to the batch size
+    batch = [_queue.get()]
+    while len(batch) < EMBED_BATCH_SIZE:
+        try:
+            batch.append(_queue.get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+
+def _finish(batch, ok: bool):
+    with _state_lock:
+        for _, _, message_id, _ in batch:
+            _queued_ids.discard(message_id)
+        _stats["done" if ok else "failed"] += len(batch)
+
+
+def _run():
+    if not embedding_service.available():
+        # Nothing can be embedded; drop the queue so progress reflects reality
+        drained = []
+        while True:
+            try:
+                drained.append(_queue.get_nowait())
+            except queue.Empty:
+                break
+        _finish(drained, ok=False)
+        return
+    while True:
+        batch = _next_batch()
+        texts = [item[3] for item in batch]
+        try:
+            vectors = embedding_service.encode(texts)
+            upsert_message_embeddings(
+                ((item[2], vec) for item, vec in zip(batch, vectors)), model=embedding_service.EMBED_MODEL
+            )
+            _finish(batch, ok=True)
+        except Exception as e:
+            _stats["last_error"] = str(e)
+            _finish(batch, ok=False)
+        if all(item[0] == PRIORITY_BACKFILL for item in batch) and EMBED_BACKFILL_PAUSE > 0:
+            time.sleep(EMBED_BACKFILL_PAUSE)
@@ -7,18 +7,29 @@ from chat_store import (
     list_conversations,
     create_conversation,
     add_message,
+    batch as chat_batch,
     get_messages,
     search_messages,
     update_conversation_title,
     delete_conversation,
-    count_messages,
-    upsert_message_embedding,
     get_messages_with_embeddings,
 )
+import embedding_service
+import embedding_worker
 import os
 import json
 import math
 
+RAG_SCAN_TTL = int(os.environ.get("RAG_SCAN_TTL", "300"))
+
+
+@st.cache_data(ttl=RAG_SCAN_TTL, show_spinner=False)
+def _scan_library():
+    """One recursive walk of the indexed Books folder per TTL: (title count, shard names)."""
+    from rag.holo_rag import list_book_files, list_shards
+    files = list_book_files()
+    return len(files), list_shards(files)
+
 st.set_page_config(page_title="Local AI ToolHub", layout="wide", initial_sidebar_state="expanded")
 st.title("📚 Local AI ToolHub – Chat + Tools")
 
@@ -31,8 +42,8 @@ if "model" not in st.session_state:
     st.session_state.model = "Qwen3 (General) ✨"
 if "selected_tool" not in st.session_state:
     st.session_state.selected_tool = "None"
-if "embedder_loaded" not in st.session_state:
-    st.session_state.embedder_loaded = False
+# Embed un-indexed history in the background (runs once per process)
+embedding_worker.backfill()
 
 # ---------- Sidebar: Conversations & Search ----------
 with st.sidebar:
@@ -52,6 +63,7 @@ with st.sidebar:
             st.rerun()
     with col_b:
         if st.button("🔄 Refresh", use_container_width=True):
+            _scan_library.clear()
             st.rerun()
 
     # Rename/Delete controls
@@ -84,29 +96,34 @@ with st.sidebar:
                     st.session_state.conversation_id = r["conversation_id"]
                     st.rerun()
     with tabs[1]:
-        def _load_embedder():
-            if not st.session_state.embedder_loaded:
-                try:
-                    from sentence_transformers import SentenceTransformer
-                    st.session_state.embedder = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
-                    st.session_state.embedder_loaded = True
-                except Exception as e:
-                    st.warning("Install sentence-transformers to enable semantic search: pip install sentence-transformers")
-                    st.session_state.embedder = None
-                    st.session_state.embedder_loaded = False
+        prog = embedding_worker.progress()
+        if prog["total"]:
+            indexed = prog["done"] + prog["failed"]
+            st.progress(indexed / prog["total"], text=f"Indexed {prog['done']}/{prog['total']} messages ({prog['pending']} pending)")
+        if prog["last_error"]:
+            st.caption(f"Embedding worker: {prog['last_error'][:200]}")
+        emb_info = embedding_service.info()
+        if emb_info["loaded"]:
+            st.caption(
+                f"Embeddings: {emb_info['model']} ({emb_info['backend']}) · "
+                f"cache {emb_info['cache_entries']} vectors, {emb_info['cache_hits']} hits"
+            )
+        if emb_info["fallback_reason"]:
+            st.warning(emb_info["fallback_reason"][:300])
 
         sem_q = st.text_input("Semantic search", placeholder="natural language query…", key="sem_search")
         if st.button("Run semantic search"):
-            _load_embedder()
-            if st.session_state.embedder_loaded:
+            # Same model as the background worker and book RAG (see embedding_service)
+            if embedding_service.available():
                 with st.spinner("Embedding and searching…"):
-                    emb = st.session_state.embedder.encode([sem_q])[0]
+                    emb = embedding_service.encode_query(sem_q)
                     # Retrieve all embeddings
                     rows = get_messages_with_embeddings()
                     candidates = []
                     for r in rows:
                         vec = None
-                        if r["vector_json"]:
+                        # Vectors from another model are not comparable; the backfill re-embeds them
+                        if r["vector_json"] and r["model"] == embedding_service.EMBED_MODEL:
                             try:
                                 vec = json.loads(r["vector_json"])
                             except Exception:
@@ -127,6 +144,7 @@ with st.sidebar:
                             st.session_state.conversation_id = r["conversation_id"]
                             st.rerun()
             else:
+                st.warning("Install sentence-transformers to enable semantic search: pip install sentence-transformers")
                 st.info("Semantic search unavailable. See warning above.")
 
     st.divider()
@@ -189,16 +207,42 @@ with st.sidebar:
     else:
         # Helper to create the Books directory
         books_dir = os.environ.get("BOOKS_DIR", os.path.join(os.path.dirname(__file__), "Books"))
-        st.caption(f"Holo1 uses Books folder: {books_dir}")
-        # Show count of .txt titles if available
+        # The RAG index reads BOOKS_DIR once at import; show (and count) that folder
+        from rag.holo_rag import BOOKS_DIR as indexed_books_dir
+        st.caption(f"Holo1 uses Books folder: {indexed_books_dir}")
+        if os.path.abspath(books_dir) != os.path.abspath(indexed_books_dir):
+            st.caption(f"BOOKS_DIR is now {books_dir}; restart the app to index it.")
+        # Show count of indexable titles (recursive, honours RAG_INCLUDE/RAG_EXCLUDE; cached, see RAG_SCAN_TTL)
+        shard_names = []
         try:
-            if os.path.isdir(books_dir):
-                txts = [f for f in os.listdir(books_dir) if f.lower().endswith('.txt')]
-                st.write(f"📚 Titles detected: {len(txts)}")
+            if os.path.isdir(indexed_books_dir):
+                title_count, shard_names = _scan_library()
+                st.write(f"📚 Titles detected: {title_count}")
             else:
                 st.write("📚 Titles detected: 0 (folder missing)")
         except Exception:
             pass
+        # Shards: one index per top-level subfolder of the Books folder
+        if shard_names:
+            st.session_state.rag_shards = st.multiselect(
+                "Search shards (empty = all)", shard_names,
+                default=[s for s in st.session_state.get("rag_shards", []) if s in shard_names],
+            )
+            rebuild_choice = st.selectbox("Rebuild one shard", shard_names)
+            if st.button("♻️ Rebuild shard"):
+                rebuild_bar = st.empty()
+
+                def _on_rebuild_progress(done, total, path):
+                    rebuild_bar.progress(done / max(total, 1), text=f"Indexing {done}/{total}: {path.name}")
+
+                try:
+                    from rag.holo_rag import holo_rebuild_shard
+                    st.success(holo_rebuild_shard(rebuild_choice, progress=_on_rebuild_progress))
+                except Exception as e:
+                    st.error(f"Rebuild failed: {e}")
+                rebuild_bar.empty()
+                # The rebuild rescanned the library; let the sidebar pick that up
+                _scan_library.clear()
         custom_dir = st.text_input("Set a custom Books folder (BOOKS_DIR)", value=books_dir, placeholder="C:/path/to/Books")
         if st.button("Use this folder"):
             try:
@@ -248,18 +292,14 @@ for msg in messages:
 # ---------- Chat Input ----------
 user_prompt = st.chat_input("Type your message…")
 if user_prompt:
-    # Save user message
-    user_msg_id = add_message(st.session_state.conversation_id, "user", user_prompt)
+    # Save user message and auto-title on the first one, in a single transaction
+    with chat_batch():
+        user_msg_id = add_message(st.session_state.conversation_id, "user", user_prompt)
+        if not messages:
+            update_conversation_title(st.session_state.conversation_id, user_prompt.strip()[:60])
     with st.chat_message("user"):
         st.markdown(user_prompt)
 
-    # Auto-title conversation on first user message
-    try:
-        if count_messages(st.session_state.conversation_id) == 1:
-            update_conversation_title(st.session_state.conversation_id, user_prompt.strip()[:60])
-    except Exception:
-        pass
-
     # Optional tool run for Qwen3
     tool_output = None
     selected_tool = st.session_state.get("selected_tool", "None")
@@ -288,7 +328,7 @@ if user_prompt:
         with st.chat_message("assistant"):
             st.markdown(f"🔧 {selected_tool} Output:")
             st.code(tool_output)
-        tool_msg_id = add_message(st.session_state.conversation_id, "tool", tool_output)
+        add_message(st.session_state.conversation_id, "tool", tool_output)
 
     # Query model
     if model_display.startswith("Qwen3"):
@@ -301,7 +341,7 @@ if user_prompt:
                 if st.button("⏹ Stop", key=f"stop_{st.session_state.conversation_id}"):
                     st.session_state["stop_stream"] = True
             try:
-                for chunk in stream_qwen3(user_prompt, tool_result=tool_output):
+                for chunk in stream_qwen3(user_prompt, tool_result=tool_output, history=messages):
                     if st.session_state.get("stop_stream"):
                         stopped = True
                         break
@@ -315,18 +355,23 @@ if user_prompt:
     else:
         with st.chat_message("assistant"):
             with st.spinner("Thinking…"):
-                response = query_model(model_display.split(" ")[0], user_prompt, tool_result=tool_output)
+                index_bar = st.empty()
+
+                def _on_index_progress(done, total, path):
+                    index_bar.progress(done / max(total, 1), text=f"Indexing books {done}/{total}: {path.name}")
+
+                response = query_model(
+                    model_display.split(" ")[0], user_prompt, tool_result=tool_output,
+                    progress=_on_index_progress, shards=st.session_state.get("rag_shards") or None,
+                )
+                index_bar.empty()
                 st.markdown(response)
 
     asst_msg_id = add_message(st.session_state.conversation_id, "assistant", response)
 
-    # Try to embed messages for semantic search
+    # Embed the new turn in the background; never blocks the rerun
     try:
-        if st.session_state.get("embedder_loaded"):
-            emb = st.session_state.embedder.encode([user_prompt, response])
-            if len(emb) == 2:
-                upsert_message_embedding(user_msg_id, emb[0].tolist() if hasattr(emb[0], 'tolist') else list(emb[0]))
-                upsert_message_embedding(asst_msg_id, emb[1].tolist() if hasattr(emb[1], 'tolist') else list(emb[1]))
+        embedding_worker.enqueue([(user_msg_id, user_prompt), (asst_msg_id, response)])
     except Exception:
         # silently ignore embedding issues
         pass
@@ -2,31 +2,28 @@
 import requests
 import os
 from rag.holo_rag import holo_query_books
+from context_builder import build_messages
 import json
 
 # Core interface for querying models
-def query_model(model_name, prompt, tool_result=None):
+def query_model(model_name, prompt, tool_result=None, history=None, progress=None, shards=None):
     if model_name == "Qwen3":
-        return query_qwen3(prompt, tool_result)
+        return query_qwen3(prompt, tool_result, history=history)
     elif model_name == "Holo1":
-        return query_holo1(prompt)
+        return query_holo1(prompt, progress=progress, shards=shards)
     else:
         return "Unknown model."
 
-def query_qwen3(prompt, tool_result=None):
+def query_qwen3(prompt, tool_result=None, history=None):
     """Query an OpenAI-compatible chat endpoint (e.g., LM Studio).
 
+    Prior turns from `history` (chat_store.get_messages) are packed by context_builder.
     Handles common response variants to avoid returning a confusing 'No content.'
     """
     # Read environment on each call to allow live updates from the UI
     lm_studio_url = os.getenv("LM_STUDIO_URL", "http://localhost:1234/v1/chat")
     lm_studio_model = os.getenv("LM_STUDIO_MODEL", "Qwen/Qwen1.5-7B-Chat-GGUF")
-    messages = [
-        {"role": "system", "content": "You are a helpful assistant."},
-        {"role": "user", "content": prompt},
-    ]
-    if tool_result:
-        messages.append({"role": "system", "content": f"Tool result: {tool_result}"})
+    messages = build_messages(prompt, history=history, tool_result=tool_result)
 
     # Build a robust chat completions URL
     url = lm_studio_url.rstrip("/")
@@ -88,11 +85,11 @@ def query_qwen3(prompt, tool_result=None):
     # 4) Fallback: return a concise dump for visibility
     return f"Unexpected response format: {str(data)[:800]}"
 
-def query_holo1(prompt):
-    return holo_query_books(prompt)
+def query_holo1(prompt, progress=None, shards=None):
+    return holo_query_books(prompt, progress=progress, shards=shards)
 
 # Streaming generator for Qwen3 (OpenAI-compatible streaming)
-def stream_qwen3(prompt, tool_result=None):
+def stream_qwen3(prompt, tool_result=None, history=None):
     """Yield text chunks from an OpenAI-compatible streaming endpoint.
 
     This attempts to parse Server-Sent Events in the typical OpenAI format.
@@ -101,12 +98,7 @@ def stream_qwen3(prompt, tool_result=None):
     lm_studio_url = os.getenv("LM_STUDIO_URL", "http://localhost:1234/v1/chat")
     lm_studio_model = os.getenv("LM_STUDIO_MODEL", "Qwen/Qwen1.5-7B-Chat-GGUF")
 
-    messages = [
-        {"role": "system", "content": "You are a helpful assistant."},
-        {"role": "user", "content": prompt},
-    ]
-    if tool_result:
-        messages.append({"role": "system", "content": f"Tool result: {tool_result}"})
+    messages = build_messages(prompt, history=history, tool_result=tool_result)
 
     url = lm_studio_url.rstrip("/")
     if url.endswith("/chat"):
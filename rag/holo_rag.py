@@ -2,21 +2,32 @@
 # RAG (Retrieval-Augmented Generation) functionality
 # rag/holo_rag.py
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+import hashlib
+import json
 import os
+import re
+import secrets
 import shutil
 import subprocess
-from typing import List
+import threading
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
 import chromadb
 from llama_index.core import (
     VectorStoreIndex,
     SimpleDirectoryReader,
+    Document,
     Settings,
     StorageContext,
     load_index_from_storage,
+    get_response_synthesizer,
 )
-from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+from llama_index.core.schema import NodeWithScore, QueryBundle
+from llama_index.core.embeddings import BaseEmbedding
 from llama_index.vector_stores.chroma import ChromaVectorStore
 from llama_index.core.node_parser import SentenceSplitter
+import embedding_service
 
 BASE_DIR = Path(__file__).resolve().parents[1]
 
@@ -27,55 +38,168 @@ CONVERT_DIR = BASE_DIR / "rag" / "converted"
 CALIBRE_BIN = os.environ.get("CALIBRE_BIN")  # optional full path to ebook-convert
 
 # Perf knobs
-RAG_MAX_FILES = int(os.environ.get("RAG_MAX_FILES", "500"))
+RAG_MAX_FILES = int(os.environ.get("RAG_MAX_FILES", "0"))  # 0 = no limit
 RAG_CHUNK_SIZE = int(os.environ.get("RAG_CHUNK_SIZE", "512"))
 RAG_TOP_K = int(os.environ.get("RAG_TOP_K", "5"))
+# PDF pages parsed and indexed per step (bounds memory for very large PDFs)
+RAG_PDF_PAGE_BATCH = int(os.environ.get("RAG_PDF_PAGE_BATCH", "16"))
+# Comma-separated globs matched against paths relative to BOOKS_DIR (e.g. "Manuals/*,*.pdf")
+RAG_INCLUDE = [g.strip() for g in os.environ.get("RAG_INCLUDE", "").split(",") if g.strip()]
+RAG_EXCLUDE = [g.strip() for g in os.environ.get("RAG_EXCLUDE", "").split(",") if g.strip()]
+# Max shards queried concurrently
+RAG_QUERY_WORKERS = int(os.environ.get("RAG_QUERY_WORKERS", "4"))
+
+# Files directly in BOOKS_DIR (not in a subfolder) belong to this shard
+DEFAULT_SHARD = "main"
+
+# progress(done_files, total_files, current_path)
+ProgressCallback = Callable[[int, int, Path], None]
 
 # Lazy singletons
 _initialized = False
-_query_engine = None
+_chroma_client = None
+_shard_files: Dict[str, List[Path]] = {}
+_shard_indexes: Dict[str, VectorStoreIndex] = {}
+# shard -> {content_hash: [file paths]} for chunks that occur in more than one place
+_shard_sources: Dict[str, Dict[str, List[str]]] = {}
+# shard -> {file path: error} for files that could not be indexed
+_shard_failures: Dict[str, Dict[str, str]] = {}
+_shards_lock = threading.RLock()
+_cap_notice: Optional[str] = None
+# Shards with a rebuild in progress, and collections replaced by finished rebuilds.
+# A replaced collection may still be read by a query that started before the swap,
+# so it is only deleted when the next rebuild starts (or at the next startup).
+_rebuilding: set = set()
+_retired_collections: List[str] = []
+
+class SharedEmbedding(BaseEmbedding):
+    """llama-index adapter over embedding_service, so RAG and chat search share one model.
+
+    Passage vectors from ingestion are not added to the shared cache (they are
+    almost all unique and never looked up again); query vectors are. Chunks
+    shared between shards get their vectors from the other shard's collection
+    instead (see _reuse_embeddings).
+    """
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return embedding_service.encode_query(query)
 
-def _persist_dir_valid() -> bool:
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return embedding_service.encode([text], store=False)[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return embedding_service.encode(texts, store=False)
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._get_query_embedding(query)
+
+    async def _aget_text_embedding(self, text: str) -> List[float]:
+        return self._get_text_embedding(text)
+
+def _persist_dir_valid(persist_dir: Path) -> bool:
     """Basic check for valid llama-index storage."""
-    if not PERSIST_DIR.exists():
+    if not persist_dir.exists():
         return False
     # Expect at least a docstore.json for a valid persisted store
-    docstore = PERSIST_DIR / "docstore.json"
+    docstore = persist_dir / "docstore.json"
     return docstore.exists()
 
-def _clear_persist_dir():
+def _clear_persist_dir(persist_dir: Path):
     try:
-        if PERSIST_DIR.exists():
-            shutil.rmtree(PERSIST_DIR)
+        if persist_dir.exists():
+            shutil.rmtree(persist_dir)
     except Exception:
         pass
 
-def _list_supported_files() -> List[Path]:
-    # Support .txt, .md always; .pdf if PyMuPDF available; epub via Calibre conversion if available
-    exts = {".txt", ".md"}
-    pdf_supported = False
+def _shard_key(shard: str) -> str:
+    """Filesystem/Chroma-safe identifier for a shard name (3-63 chars, alphanumeric ends)."""
+    slug = re.sub(r"[^A-Za-z0-9_-]+", "_", shard).strip("_-")[:40] or "shard"
+    digest = hashlib.sha1(shard.encode("utf-8")).hexdigest()[:8]
+    return f"{slug}_{digest}"
+
+def _shard_persist_dir(shard: str) -> Path:
+    return PERSIST_DIR / _shard_key(shard)
+
+def _shard_collection_name(shard: str) -> str:
+    return f"books_{_shard_key(shard)}"
+
+def _shard_of(path: Path) -> str:
+    """Shard = top-level subfolder of BOOKS_DIR (or of CONVERT_DIR for converted EPUBs)."""
+    for root in (CONVERT_DIR, BOOKS_DIR):
+        try:
+            rel = path.relative_to(root)
+        except ValueError:
+            continue
+        return rel.parts[0] if len(rel.parts) > 1 else DEFAULT_SHARD
+    return DEFAULT_SHARD
+
+def _pdf_supported() -> bool:
     try:
         import fitz  # PyMuPDF
-        pdf_supported = True
+        return True
     except Exception:
-        pdf_supported = False
-    if pdf_supported:
+        return False
+
+def _walk_files(root: Path) -> Iterator[Path]:
+    """Yield files under root recursively, in sorted order, skipping hidden entries."""
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+        for name in sorted(filenames):
+            if not name.startswith("."):
+                yield Path(dirpath) / name
+
+def _matches_filters(rel_path: str) -> bool:
+    if RAG_INCLUDE and not any(fnmatch(rel_path, g) for g in RAG_INCLUDE):
+        return False
+    return not any(fnmatch(rel_path, g) for g in RAG_EXCLUDE)
+
+def _scan_books() -> Tuple[List[Path], int]:
+    """Recursively collect supported files under BOOKS_DIR plus converted EPUBs.
+
+    Returns (files, skipped) where skipped counts files left out by RAG_MAX_FILES.
+    """
+    # Support .txt, .md always; .pdf if PyMuPDF available; epub via Calibre conversion if available
+    exts = {".txt", ".md"}
+    if _pdf_supported():
         exts.add(".pdf")
 
     files: List[Path] = []
+    convert_dir = CONVERT_DIR.resolve()
     if BOOKS_DIR.exists():
-        for p in BOOKS_DIR.iterdir():
-            if p.is_file() and p.suffix.lower() in exts:
+        for p in _walk_files(BOOKS_DIR):
+            if p.suffix.lower() not in exts or convert_dir in p.resolve().parents:
+                continue
+            if _matches_filters(p.relative_to(BOOKS_DIR).as_posix()):
                 files.append(p)
-    # Include previously converted EPUB->TXT files
+    # Include previously converted EPUB->TXT files (mirrors the BOOKS_DIR layout)
     if CONVERT_DIR.exists():
-        for p in CONVERT_DIR.iterdir():
-            if p.is_file() and p.suffix.lower() in {".txt", ".md"}:
+        for p in _walk_files(CONVERT_DIR):
+            if p.suffix.lower() in {".txt", ".md"} and _matches_filters(p.relative_to(CONVERT_DIR).as_posix()):
                 files.append(p)
-    # Cap total files for performance
-    if len(files) > RAG_MAX_FILES:
+    skipped = 0
+    if RAG_MAX_FILES > 0 and len(files) > RAG_MAX_FILES:
+        skipped = len(files) - RAG_MAX_FILES
         files = files[:RAG_MAX_FILES]
-    return files
+    return files, skipped
+
+def _cap_notice_for(files: List[Path], skipped: int) -> Optional[str]:
+    if not skipped:
+        return None
+    return f"Note: indexed the first {len(files)} files; {skipped} more skipped by RAG_MAX_FILES."
+
+def list_book_files() -> List[Path]:
+    """Files that would be indexed with the current BOOKS_DIR and filters."""
+    return _scan_books()[0]
+
+def _group_by_shard(files: List[Path]) -> Dict[str, List[Path]]:
+    shards: Dict[str, List[Path]] = {}
+    for p in files:
+        shards.setdefault(_shard_of(p), []).append(p)
+    return shards
+
+def list_shards(files: Optional[List[Path]] = None) -> List[str]:
+    """Shard names for the given files (default: a fresh scan of BOOKS_DIR), sorted."""
+    return sorted(_group_by_shard(list_book_files() if files is None else files))
 
 def _which(cmd: str) -> bool:
     try:
@@ -85,13 +209,16 @@ def _which(cmd: str) -> bool:
         return False
 
 def _convert_epubs_if_possible() -> str | None:
-    """Convert .epub files in BOOKS_DIR to .txt into CONVERT_DIR using Calibre's ebook-convert if available.
-    Returns an info message if conversion ran, else None.
+    """Convert .epub files under BOOKS_DIR to .txt into CONVERT_DIR using Calibre's ebook-convert if available.
+    Subfolders are mirrored in CONVERT_DIR. Returns an info message if conversion ran, else None.
     """
     if not BOOKS_DIR.exists():
         return None
     # Find epubs
-    epubs = [p for p in BOOKS_DIR.iterdir() if p.is_file() and p.suffix.lower() == ".epub"]
+    epubs = [
+        p for p in _walk_files(BOOKS_DIR)
+        if p.suffix.lower() == ".epub" and _matches_filters(p.relative_to(BOOKS_DIR).as_posix())
+    ]
     if not epubs:
         return None
     # Prefer explicit CALIBRE_BIN if provided
@@ -103,7 +230,8 @@ def _convert_epubs_if_possible() -> str | None:
     CONVERT_DIR.mkdir(parents=True, exist_ok=True)
     converted = 0
     for epub in epubs:
-        out_txt = CONVERT_DIR / (epub.stem + ".txt")
+        out_txt = CONVERT_DIR / epub.relative_to(BOOKS_DIR).with_suffix(".txt")
+        out_txt.parent.mkdir(parents=True, exist_ok=True)
         # Skip if already converted and newer than source
         if out_txt.exists() and out_txt.stat().st_mtime >= epub.stat().st_mtime:
             continue
@@ -116,13 +244,241 @@ def _convert_epubs_if_possible() -> str | None:
         return f"Converted {converted} EPUB file(s) via Calibre."
     return None
 
+def _iter_pdf_documents(path: Path) -> Iterator[List[Document]]:
+    """Yield a PDF as batches of per-page Documents so the whole file is never held in memory."""
+    import fitz  # PyMuPDF
+    with fitz.open(str(path)) as pdf:
+        batch: List[Document] = []
+        for page_no, page in enumerate(pdf, start=1):
+            text = page.get_text()
+            if text.strip():
+                batch.append(Document(
+                    text=text,
+                    metadata={"file_path": str(path), "file_name": path.name, "page_label": str(page_no)},
+                ))
+            if len(batch) >= RAG_PDF_PAGE_BATCH:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+def _iter_documents(path: Path) -> Iterator[List[Document]]:
+    if path.suffix.lower() == ".pdf":
+        yield from _iter_pdf_documents(path)
+    else:
+        yield SimpleDirectoryReader(input_files=[str(path)]).load_data()
+
+_WORD_RE = re.compile(r"\w+")
+CHUNK_SOURCES_FILE = "chunk_sources.json"
+FAILED_FILES_FILE = "failed_files.json"
+INDEX_META_FILE = "index_meta.json"
+
+def _content_hash(text: str) -> str:
+    """Hash of a chunk's words, ignoring case, punctuation and whitespace/line wrapping."""
+    normalized = " ".join(_WORD_RE.findall(text.lower()))
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+def _load_json(path: Path) -> dict:
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except Exception:
+        return {}
+
+def _failure_notice(shards: List[str]) -> Optional[str]:
+    failed = [Path(p).name for s in shards for p in _shard_failures.get(s, {})]
+    if not failed:
+        return None
+    shown = ", ".join(failed[:5]) + (f" (+{len(failed) - 5} more)" if len(failed) > 5 else "")
+    return f"Note: {len(failed)} file(s) could not be indexed and were skipped: {shown}."
+
+def _current_collection_name(shard: str) -> str:
+    """Collection the shard's persisted storage belongs to (rebuilds use a fresh name)."""
+    meta = _load_json(_shard_persist_dir(shard) / INDEX_META_FILE)
+    return meta.get("collection") or _shard_collection_name(shard)
+
+def _write_index_meta(persist_dir: Path, collection_name: str):
+    meta = {"collection": collection_name, "embed_model": embedding_service.EMBED_MODEL}
+    (persist_dir / INDEX_META_FILE).write_text(json.dumps(meta), encoding="utf-8")
+
+def _reusable_collections(shard: str) -> list:
+    """Other shards' collections whose vectors came from the current embedding model."""
+    collections = []
+    with _shards_lock:
+        others = [s for s in _shard_files if s != shard]
+    for other in others:
+        meta = _load_json(_shard_persist_dir(other) / INDEX_META_FILE)
+        if meta.get("embed_model") != embedding_service.EMBED_MODEL:
+            continue
+        try:
+            collections.append(_chroma_client.get_collection(meta["collection"]))
+        except Exception:
+            continue
+    return collections
+
+def _reuse_embeddings(nodes: list, collections: list):
+    """Copy vectors for chunks another shard already embedded; llama-index skips nodes that have one."""
+    pending = {n.id_: n for n in nodes}
+    for collection in collections:
+        if not pending:
+            break
+        try:
+            found = collection.get(ids=list(pending), include=["embeddings"])
+        except Exception:
+            continue  # e.g. collection retired by a concurrent rebuild
+        vectors = found.get("embeddings")
+        if vectors is None:
+            continue
+        for node_id, vec in zip(found["ids"], vectors):
+            node = pending.pop(node_id, None)
+            if node is not None:
+                node.embedding = vec.tolist() if hasattr(vec, "tolist") else list(vec)
+
+def _drop_orphan_collections():
+    """At startup, delete book collections no shard's storage points at, and half-finished rebuilds."""
+    keep = set()
+    if PERSIST_DIR.exists():
+        for d in PERSIST_DIR.iterdir():
+            if not d.is_dir():
+                continue
+            if d.name.endswith((".next", ".old")):
+                _clear_persist_dir(d)
+                continue
+            keep.add(_load_json(d / INDEX_META_FILE).get("collection") or f"books_{d.name}")
+    try:
+        collections = _chroma_client.list_collections()
+    except Exception:
+        return
+    for c in collections:
+        name = getattr(c, "name", c)  # chromadb >= 0.6 returns plain names
+        if name.startswith("books_") and name not in keep:
+            try:
+                _chroma_client.delete_collection(name)
+            except Exception:
+                pass
+
+def _sources_for(content_hash: str) -> List[str]:
+    found: List[str] = []
+    for sources in _shard_sources.values():
+        for src in sources.get(content_hash, []):
+            if src not in found:
+                found.append(src)
+    return found
+
+def _build_index(
+    files: List[Path],
+    vector_store,
+    persist_dir: Path,
+    progress: Optional[ProgressCallback] = None,
+    reuse_from: Optional[list] = None,
+):
+    """Chunk and index files one at a time (PDFs page batch by page batch), then persist.
+
+    Chunks are keyed by content hash: a chunk already seen in this shard is not embedded
+    or stored again, only its extra source is recorded in chunk_sources.json. A chunk
+    already in one of the `reuse_from` collections (other shards) is stored with its
+    vector copied from there instead of being embedded again.
+    A file that fails to read is rolled back (including pages already indexed) and
+    recorded in failed_files.json.
+    """
+    # Fresh storage context without persist_dir to avoid reading non-existent files
+    storage_context = StorageContext.from_defaults(vector_store=vector_store)
+    index = VectorStoreIndex([], storage_context=storage_context)
+    parser = SentenceSplitter()
+    total = len(files)
+    seen: Dict[str, List[str]] = {}
+    failed: Dict[str, str] = {}
+    for i, path in enumerate(files, start=1):
+        # What this file contributed, so a failure partway through can be undone
+        new_hashes: List[str] = []
+        added_sources: List[Tuple[str, str]] = []
+        try:
+            for documents in _iter_documents(path):
+                nodes = []
+                for node in parser.get_nodes_from_documents(documents):
+                    text = node.get_content()
+                    if not text.strip():
+                        continue
+                    content_hash = _content_hash(text)
+                    source = node.metadata.get("file_path", str(path))
+                    if content_hash in seen:
+                        if source not in seen[content_hash]:
+                            seen[content_hash].append(source)
+                            added_sources.append((content_hash, source))
+                        continue
+                    seen[content_hash] = [source]
+                    new_hashes.append(content_hash)
+                    node.id_ = content_hash
+                    node.metadata["content_hash"] = content_hash
+                    # Embed the text alone so identical chunks get identical vectors whatever their source
+                    node.excluded_embed_metadata_keys = list(node.metadata.keys())
+                    node.excluded_llm_metadata_keys = list(set(node.excluded_llm_metadata_keys) | {"content_hash"})
+                    nodes.append(node)
+                if nodes:
+                    if reuse_from:
+                        _reuse_embeddings(nodes, reuse_from)
+                    index.insert_nodes(nodes)
+        except Exception as e:
+            # Skip unreadable files rather than failing the whole build, but say so
+            failed[str(path)] = str(e)[:300]
+            for content_hash, source in added_sources:
+                seen[content_hash].remove(source)
+            for content_hash in new_hashes:
+                seen.pop(content_hash, None)
+            if new_hashes:
+                try:
+                    index.delete_nodes(new_hashes, delete_from_docstore=True)
+                except Exception:
+                    pass
+        if progress:
+            progress(i, total, path)
+    persist_dir.mkdir(parents=True, exist_ok=True)
+    index.storage_context.persist(persist_dir=str(persist_dir))
+    duplicates = {h: srcs for h, srcs in seen.items() if len(srcs) > 1}
+    (persist_dir / CHUNK_SOURCES_FILE).write_text(json.dumps(duplicates), encoding="utf-8")
+    (persist_dir / FAILED_FILES_FILE).write_text(json.dumps(failed), encoding="utf-8")
+    return index
+
+def _load_or_build_shard(shard: str, progress: Optional[ProgressCallback] = None) -> VectorStoreIndex:
+    """Open a shard's own Chroma collection and storage, building it if missing or corrupt."""
+    with _shards_lock:
+        if shard in _shard_indexes:
+            return _shard_indexes[shard]
+        persist_dir = _shard_persist_dir(shard)
+        collection_name = _current_collection_name(shard)
+        chroma_collection = _chroma_client.get_or_create_collection(collection_name)
+        vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
+        index = None
+        if _persist_dir_valid(persist_dir):
+            try:
+                storage_context = StorageContext.from_defaults(
+                    persist_dir=str(persist_dir), vector_store=vector_store
+                )
+                index = load_index_from_storage(storage_context)
+            except Exception:
+                # Storage appears corrupted/partial; rebuild this shard only
+                _clear_persist_dir(persist_dir)
+        if index is None:
+            # Start from an empty collection so a partial previous build doesn't leave duplicates
+            if chroma_collection.count():
+                _chroma_client.delete_collection(collection_name)
+                chroma_collection = _chroma_client.get_or_create_collection(collection_name)
+                vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
+            index = _build_index(
+                _shard_files.get(shard, []), vector_store, persist_dir, progress, _reusable_collections(shard)
+            )
+            _write_index_meta(persist_dir, collection_name)
+        _shard_sources[shard] = _load_json(persist_dir / CHUNK_SOURCES_FILE)
+        _shard_failures[shard] = _load_json(persist_dir / FAILED_FILES_FILE)
+        _shard_indexes[shard] = index
+        return index
+
 def _ensure_initialized():
     """Initialize RAG components once, if possible.
 
     Returns:
         tuple[bool, str | None]: (ok, error_message)
     """
-    global _initialized, _query_engine
+    global _initialized, _chroma_client, _shard_files, _cap_notice
     if _initialized:
         return True, None
 
@@ -136,23 +492,22 @@ def _ensure_initialized():
     # Attempt EPUB conversion if possible, then gather files
     _convert_epubs_if_possible()
     # Check for supported files
-    files = _list_supported_files()
+    files, skipped = _scan_books()
     if not files:
         # Provide targeted guidance if folder only has unsupported types
-        has_any = any(BOOKS_DIR.iterdir())
-        msg = "No supported files found. Add .txt or .md"
-        # Check for PDFs without PyMuPDF
         try:
-            pdfs_present = any(p.suffix.lower() == ".pdf" for p in BOOKS_DIR.iterdir())
+            suffixes = {p.suffix.lower() for p in _walk_files(BOOKS_DIR)}
         except Exception:
-            pdfs_present = False
+            suffixes = set()
+        msg = "No supported files found. Add .txt or .md"
+        if RAG_INCLUDE or RAG_EXCLUDE:
+            msg += " (or relax RAG_INCLUDE/RAG_EXCLUDE)"
+        # Check for PDFs without PyMuPDF
+        pdfs_present = ".pdf" in suffixes
         if pdfs_present:
             msg += ", or install 'pymupdf' to enable PDF support (pip install pymupdf)"
         # Check for epubs
-        try:
-            epubs_present = any(p.suffix.lower() == ".epub" for p in BOOKS_DIR.iterdir())
-        except Exception:
-            epubs_present = False
+        epubs_present = ".epub" in suffixes
         if epubs_present:
             if _which("ebook-convert"):
                 msg += ". EPUB will be auto-converted via Calibre on next run."
@@ -161,63 +516,158 @@ def _ensure_initialized():
         return False, f"Books folder: {BOOKS_DIR}. {msg}."
 
     # Configure embeddings and vector store
-    embed_model = HuggingFaceEmbedding(model_name="BAAI/bge-small-en-v1.5")
+    if not embedding_service.available():
+        return False, embedding_service.load_error()
+    embed_model = SharedEmbedding(
+        model_name=embedding_service.EMBED_MODEL,
+        embed_batch_size=embedding_service.EMBED_BATCH_SIZE,
+    )
     Settings.embed_model = embed_model
     Settings.chunk_size = RAG_CHUNK_SIZE
 
-    chroma_client = chromadb.PersistentClient(path=str(CHROMA_DIR))
-    chroma_collection = chroma_client.get_or_create_collection("books")
-    vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
+    _chroma_client = chromadb.PersistentClient(path=str(CHROMA_DIR))
+    _drop_orphan_collections()
+    _shard_files = _group_by_shard(files)
+    _initialized = True
+    _cap_notice = _cap_notice_for(files, skipped)
+    return True, None
 
-    # Load or build index
-    if _persist_dir_valid():
+def _rescan() -> Dict[str, List[Path]]:
+    """Convert EPUBs added since startup, rescan BOOKS_DIR and refresh the RAG_MAX_FILES notice."""
+    global _cap_notice
+    _convert_epubs_if_possible()
+    files, skipped = _scan_books()
+    _cap_notice = _cap_notice_for(files, skipped)
+    return _group_by_shard(files)
+
+def holo_rebuild_shard(shard: str, progress: Optional[ProgressCallback] = None) -> str:
+    """Rebuild one shard's collection and storage; other shards are untouched.
+
+    The new index is built beside the live one and swapped in when complete, so
+    queries keep answering from the old index meanwhile. Returns a summary
+    message; raises RuntimeError if the RAG stack cannot start or the shard is
+    already being rebuilt.
+    """
+    ok, err = _ensure_initialized()
+    if not ok:
+        raise RuntimeError(err)
+    with _shards_lock:
+        if shard in _rebuilding:
+            raise RuntimeError(f"Shard '{shard}' is already being rebuilt.")
+        _rebuilding.add(shard)
+        # Replaced by an earlier rebuild; queries that could still read them have finished
+        stale = list(_retired_collections)
+        _retired_collections.clear()
+    try:
+        for name in stale:
+            try:
+                _chroma_client.delete_collection(name)
+            except Exception:
+                pass
+        files = _rescan().get(shard, [])
+        persist_dir = _shard_persist_dir(shard)
+        if not files:
+            with _shards_lock:
+                _retired_collections.append(_current_collection_name(shard))
+                for table in (_shard_files, _shard_indexes, _shard_sources, _shard_failures):
+                    table.pop(shard, None)
+                _clear_persist_dir(persist_dir)
+            return f"Shard '{shard}' has no files; removed its index."
+
+        staging_dir = persist_dir.with_name(persist_dir.name + ".next")
+        _clear_persist_dir(staging_dir)
+        collection_name = f"{_shard_collection_name(shard)}_{secrets.token_hex(3)}"
+        collection = _chroma_client.get_or_create_collection(collection_name)
         try:
-            storage_context = StorageContext.from_defaults(
-                persist_dir=str(PERSIST_DIR), vector_store=vector_store
+            index = _build_index(
+                files, ChromaVectorStore(chroma_collection=collection), staging_dir, progress,
+                _reusable_collections(shard),
             )
-            index = load_index_from_storage(storage_context)
-        except Exception:
-            # Storage appears corrupted/partial; rebuild
-            _clear_persist_dir()
-            documents = SimpleDirectoryReader(
-                input_files=[str(p) for p in files]
-            ).load_data()
-            parser = SentenceSplitter()
-            nodes = parser.get_nodes_from_documents(documents)
-            # Fresh storage context without persist_dir to avoid reading non-existent files
-            storage_context = StorageContext.from_defaults(
-                vector_store=vector_store
-            )
-            index = VectorStoreIndex(nodes, storage_context=storage_context)
-            PERSIST_DIR.mkdir(parents=True, exist_ok=True)
-            index.storage_context.persist(persist_dir=str(PERSIST_DIR))
-    else:
-        # Fresh build; attempt PDF parsing if available
-        # Fresh build; build from gathered files
-        try:
-            documents = SimpleDirectoryReader(input_files=[str(p) for p in files]).load_data()
+            _write_index_meta(staging_dir, collection_name)
         except Exception:
-            # If some inputs cause issues, filter by extension to txt/md
-            txt_md = [str(p) for p in files if Path(p).suffix.lower() in {".txt", ".md"}]
-            documents = SimpleDirectoryReader(input_files=txt_md).load_data()
-        parser = SentenceSplitter()
-        nodes = parser.get_nodes_from_documents(documents)
-        # Fresh storage context without persist_dir to avoid reading non-existent files
-        storage_context = StorageContext.from_defaults(
-            vector_store=vector_store
-        )
-        index = VectorStoreIndex(nodes, storage_context=storage_context)
-        PERSIST_DIR.mkdir(parents=True, exist_ok=True)
-        index.storage_context.persist(persist_dir=str(PERSIST_DIR))
+            _clear_persist_dir(staging_dir)
+            try:
+                _chroma_client.delete_collection(collection_name)
+            except Exception:
+                pass
+            raise
 
-    _query_engine = index.as_query_engine(similarity_top_k=RAG_TOP_K)
-    _initialized = True
-    return True, None
+        with _shards_lock:
+            _retired_collections.append(_current_collection_name(shard))
+            retired_dir = persist_dir.with_name(persist_dir.name + ".old")
+            _clear_persist_dir(retired_dir)
+            if persist_dir.exists():
+                persist_dir.rename(retired_dir)
+            staging_dir.rename(persist_dir)
+            _clear_persist_dir(retired_dir)
+            _shard_files[shard] = files
+            _shard_indexes[shard] = index
+            _shard_sources[shard] = _load_json(persist_dir / CHUNK_SOURCES_FILE)
+            _shard_failures[shard] = _load_json(persist_dir / FAILED_FILES_FILE)
+            reused = sum(len(srcs) - 1 for srcs in _shard_sources[shard].values())
+            failures = _failure_notice([shard])
+    finally:
+        with _shards_lock:
+            _rebuilding.discard(shard)
+    message = f"Rebuilt shard '{shard}' ({len(files)} files, {reused} duplicate chunks reused)."
+    return f"{message} {failures}" if failures else message
+
+def _retrieve_merged(prompt: str, indexes: List[VectorStoreIndex]):
+    """Retrieve top-k from each shard index concurrently, merge by score and drop duplicate chunks."""
+    # Embed the query once and hand the vector to every shard's retriever
+    bundle = QueryBundle(query_str=prompt, embedding=Settings.embed_model.get_query_embedding(prompt))
+    retrievers = [index.as_retriever(similarity_top_k=RAG_TOP_K) for index in indexes]
+    with ThreadPoolExecutor(max_workers=max(1, min(RAG_QUERY_WORKERS, len(retrievers)))) as pool:
+        results = list(pool.map(lambda r: r.retrieve(bundle), retrievers))
+    merged = [n for nodes in results for n in nodes]
+    merged.sort(key=lambda n: n.score or 0.0, reverse=True)
+    # The same text can live in several shards; keep the best-scoring copy and list the other sources
+    best: Dict[str, NodeWithScore] = {}
+    sources: Dict[str, List[str]] = {}
+    for n in merged:
+        content_hash = n.node.metadata.get("content_hash") or _content_hash(n.node.get_content())
+        best.setdefault(content_hash, n)
+        srcs = sources.setdefault(content_hash, _sources_for(content_hash))
+        src = n.node.metadata.get("file_path")
+        if src and src not in srcs:
+            srcs.append(src)
+    top = list(best.items())[:RAG_TOP_K]
+    for content_hash, n in top:
+        primary = n.node.metadata.get("file_path")
+        others = [s for s in sources[content_hash] if s != primary]
+        if others:
+            n.node.metadata["also_in"] = "; ".join(others)
+    return [n for _, n in top]
 
 # Callable function for Streamlit
-def holo_query_books(prompt: str) -> str:
+def holo_query_books(
+    prompt: str,
+    progress: Optional[ProgressCallback] = None,
+    shards: Optional[List[str]] = None,
+) -> str:
+    """Answer from the selected shards (all shards when `shards` is empty/None)."""
     ok, err = _ensure_initialized()
     if not ok:
         return err
-    response = _query_engine.query(prompt)
+    requested = shards or sorted(_shard_files)
+    if any(s not in _shard_files for s in requested):
+        # Subfolders added since startup: rescan and index them on first use
+        found = _rescan()
+        with _shards_lock:
+            for s in requested:
+                if s not in _shard_files and found.get(s):
+                    _shard_files[s] = found[s]
+    selected = [s for s in requested if s in _shard_files]
+    dropped = [s for s in requested if s not in _shard_files]
+    if not selected:
+        return f"No indexed files in the selected shard(s): {', '.join(requested)}."
+    with _shards_lock:
+        # Query this snapshot; a rebuild swaps in a new index without disturbing it
+        indexes = [_load_or_build_shard(shard, progress) for shard in selected if shard in _shard_files]
+    nodes = _retrieve_merged(prompt, indexes)
+    response = get_response_synthesizer().synthesize(prompt, nodes=nodes)
+    skipped_notice = f"Note: no indexable files in shard(s) {', '.join(dropped)}; skipped." if dropped else None
+    notices = [n for n in (_cap_notice, _failure_notice(selected), skipped_notice) if n]
+    if notices:
+        return f"{response}\n\n" + "\n\n".join(f"_{n}_" for n in notices)
     return str(response)